@@ -1,127 +1,340 @@
 import asyncio
 import aiohttp
-import gspread
+import contextlib
+import functools
+import hashlib
+import math
 import os
 import json
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
+import orjson
+import ijson
 import random
-from io import StringIO
+import ssl
+import tempfile
+import certifi
+import time
+from datetime import datetime, timezone
+from dataclasses import dataclass
+from typing import Optional
 from aiohttp import web
 
+# ---- Runtime Configuration ----
+@dataclass(frozen=True)
+class Config:
+    binance_host: str = "https://api.binance.us"
+    loop_interval: float = 5  # Seconds between sheet updates
+    pairs_cache_file: Optional[str] = ".usdt_pairs.json"  # Shares the pair list across runs; None disables
+    token_cache_file: Optional[str] = ".gsheet_token"  # Reuses the Sheets access token across runs; None disables
+
+    @classmethod
+    def from_env(cls):
+        loop_interval = float(os.getenv("UPDATE_INTERVAL", cls.loop_interval))
+        if not (math.isfinite(loop_interval) and loop_interval > 0):
+            raise ValueError("UPDATE_INTERVAL must be a positive, finite number of seconds")
+
+        return cls(
+            binance_host=os.getenv("BINANCE_HOST", cls.binance_host).rstrip("/"),
+            loop_interval=loop_interval,
+            pairs_cache_file=os.getenv("PAIRS_CACHE_FILE", cls.pairs_cache_file) or None,
+            token_cache_file=os.getenv("GSHEET_TOKEN_CACHE", cls.token_cache_file) or None
+        )
+
+CONFIG = Config.from_env()
+
 # ---- Google Sheets Authentication ----
 credentials_json = os.getenv("GOOGLE_CREDENTIALS")
 if not credentials_json:
     raise ValueError("Missing Google credentials in environment variables")
 
-creds_dict = json.loads(credentials_json)
-creds_file = StringIO(json.dumps(creds_dict))
-
-# Authenticate with Google Sheets
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-client = gspread.authorize(creds)
 SHEET_NAME = os.getenv("SHEET_NAME", "Crypto_Tracker")
 if not SHEET_NAME:
     raise ValueError("Missing SHEET_NAME environment variable")
 
-sheet = client.open(SHEET_NAME).sheet1  # First sheet
+# ---- Cached Sheets Access Token ----
+# google-auth keeps expiry as a naive UTC datetime; the cache file stores it as epoch seconds
+def load_token(auth, path, account):
+    try:
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+        if cached["account"] != account:
+            return
+        token = cached["token"]
+        if not isinstance(token, str):
+            raise TypeError("token is not a string")
+        # Parse before touching auth, so a bad entry can't leave a token installed without an expiry
+        expiry = datetime.fromtimestamp(cached["expiry"], timezone.utc).replace(tzinfo=None)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError, OverflowError) as e:
+        print(f"⚠️ Ignoring Sheets token cache: {e}")
+        return
+
+    auth.token, auth.expiry = token, expiry
+    # google-auth treats tokens close to expiry as expired; drop those rather than refresh on first use
+    if not auth.valid:
+        auth.token = auth.expiry = None
+        print(f"⚠️ Ignoring Sheets token cache: {e}")
+
+def save_token(auth, path, account):
+    if not auth.token or not auth.expiry:
+        return
+    cached = {"account": account, "token": auth.token, "expiry": auth.expiry.replace(tzinfo=timezone.utc).timestamp()}
+    try:
+        # The token grants access to the sheet, so keep the file private to this user
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # The mode above only applies when the file is created
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(cached))
+    except OSError as e:
+        print(f"⚠️ Could not write Sheets token cache: {e}")
+
+# Credentials are parsed and authorized once, on first use; call via asyncio.to_thread since it blocks.
+# The Google client libraries are imported here so startup (and the health check) doesn't wait on them.
+@functools.lru_cache(maxsize=1)
+def get_sheet():
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    from requests.adapters import HTTPAdapter
+
+    creds_dict = json.loads(credentials_json)
+
+    # Authenticate with Google Sheets
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    client = gspread.authorize(creds)
+    # Reuse pooled keep-alive connections to the Sheets API across writes
+    client.http_client.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=3))
+
+    # A still-valid token from a previous run skips the OAuth token exchange
+    auth = client.http_client.auth
+    account = creds_dict.get("client_email")
+    if CONFIG.token_cache_file:
+        load_token(auth, CONFIG.token_cache_file, account)
+    sheet = client.open(SHEET_NAME).sheet1  # First sheet
+    if CONFIG.token_cache_file:
+        save_token(auth, CONFIG.token_cache_file, account)
+    return sheet
 
 # ---- Binance API Configuration ----
 BINANCE_API_KEY = os.getenv("api")  # Load from environment
 HEADERS = {"X-MBX-APIKEY": BINANCE_API_KEY} if BINANCE_API_KEY else {}
+MAX_CONNECTIONS_PER_HOST = 20
+SSL_CTX = ssl.create_default_context(cafile=certifi.where())  # Built once, verifies Binance's certificate
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=5, sock_read=5)
+MAX_RETRIES = 3
+MAX_BACKOFF = 60  # Seconds
+RETRY_STATUSES = {418, 429, 500, 502, 503, 504}  # Rate limits and transient server errors
+
+def next_backoff(previous):
+    # Decorrelated jitter: draw the next wait from [1, 3x the previous one] so retries don't sync up
+    return min(MAX_BACKOFF, random.uniform(1, max(1, previous * 3)))
+
+# ---- Shared HTTP Session ----
+def create_session():
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=MAX_CONNECTIONS_PER_HOST, ttl_dns_cache=300, ssl=SSL_CTX),
+        timeout=REQUEST_TIMEOUT,
+        headers=HEADERS
+    )
+
+# ---- GET With Retries ----
+async def read_json(response):
+    return orjson.loads(await response.read())
+
+async def get_with_retries(session, url, read=read_json):
+    wait_time = 0
+    for attempt in range(1, MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await read(response)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                raise
+            retry_after = e.headers.get("Retry-After") if e.headers else None
+            print(f"⚠️ {url} returned {e.status} (attempt {attempt}/{MAX_RETRIES})")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"⚠️ {url} failed (attempt {attempt}/{MAX_RETRIES}): {e!r}")
+
+        # Honour Binance's Retry-After on rate limits, otherwise back off with jitter
+        try:
+            wait_time = min(MAX_BACKOFF, float(retry_after))
+        except (TypeError, ValueError):
+            wait_time = next_backoff(wait_time)
+        await asyncio.sleep(wait_time)
 
 # ---- Fetch All USDT Trading Pairs ----
-async def get_usdt_pairs():
-    url = "https://api.binance.us/api/v3/exchangeInfo"
+PAIRS_TTL = 3600  # The pair list only changes a few times a day
+pairs_cache = {"fetched_at": 0.0, "pairs": []}
+
+# Same mode open() would give a new file: 0666 minus the process umask (which can only be read by setting it)
+_umask = os.umask(0)
+os.umask(_umask)
+PAIRS_FILE_MODE = 0o666 & ~_umask
+
+async def read_usdt_pairs(response):
+    # Stream the symbol names out of the payload instead of materializing every filter/permission
+    return [s async for s in ijson.items(response.content, "symbols.item.symbol") if s.endswith("USDT")]
+
+# The file's mtime is the fetch time, so a fresh file written by another run skips exchangeInfo too
+def load_pairs_file(path):
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age < PAIRS_TTL:
+            with open(path, "rb") as f:
+                pairs = orjson.loads(f.read())
+            if not isinstance(pairs, list) or not all(isinstance(p, str) for p in pairs):
+                raise ValueError("expected a list of symbol names")
+            pairs_cache.update(fetched_at=time.monotonic() - age, pairs=pairs)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Ignoring USDT pairs cache file: {e}")
+
+def save_pairs_file(path, pairs):
+    tmp_path = None
     try:
-        async with aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=5),
-            connector=aiohttp.TCPConnector(ssl=False)
-        ) as session:
-            async with session.get(url, headers=HEADERS) as response:
-                data = await response.json()
-                return [s["symbol"] for s in data.get("symbols", []) if s["symbol"].endswith("USDT")]
+        # A unique temp file per write, so concurrent runs never share (and interleave) one
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".usdt_pairs.")
+        os.fchmod(fd, PAIRS_FILE_MODE)  # mkstemp creates 0600; other users' runs need to read it too
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(pairs))
+        os.replace(tmp_path, path)  # Atomic, so readers never see a partial file
+    except OSError as e:
+        print(f"⚠️ Could not write USDT pairs cache file: {e}")
+        if tmp_path:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+async def get_usdt_pairs(session):
+    if not pairs_cache["pairs"] and CONFIG.pairs_cache_file and os.path.exists(CONFIG.pairs_cache_file):
+        load_pairs_file(CONFIG.pairs_cache_file)
+    if pairs_cache["pairs"] and time.monotonic() - pairs_cache["fetched_at"] < PAIRS_TTL:
+        return pairs_cache["pairs"]
+
+    url = f"{CONFIG.binance_host}/api/v3/exchangeInfo"
+    try:
+        pairs = await get_with_retries(session, url, read_usdt_pairs)
     except Exception as e:
         print(f"⚠️ Error fetching USDT pairs: {e}")
-        return []
+        return pairs_cache["pairs"]  # Keep serving the last known list
+
+    if pairs:
+        pairs_cache.update(fetched_at=time.monotonic(), pairs=pairs)
+        if CONFIG.pairs_cache_file:
+            save_pairs_file(CONFIG.pairs_cache_file, pairs)
+    return pairs
 
-# ---- Fetch Live Prices ----
-async def fetch_prices(symbols):
-    url = "https://api.binance.us/api/v3/ticker/price"
+# ---- Fetch Live And Previous Closing Prices ----
+async def fetch_tickers_24hr(session):
+    url = f"{CONFIG.binance_host}/api/v3/ticker/24hr"
     try:
-        async with aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=5),
-            connector=aiohttp.TCPConnector(ssl=False)
-        ) as session:
-            async with session.get(url, headers=HEADERS) as response:
-                data = await response.json()
-                return {item["symbol"]: float(item["price"]) for item in data if item["symbol"] in symbols}
+        data = await get_with_retries(session, url)
+        return {item["symbol"]: (float(item["lastPrice"]), float(item["prevClosePrice"])) for item in data}
     except Exception as e:
-        print(f"⚠️ Error fetching prices: {e}")
+        print(f"⚠️ Error fetching 24hr tickers: {e}")
         return {}
 
-# ---- Fetch Previous Day's Closing Prices ----
-async def fetch_historical_data(symbols):
-    url = "https://api.binance.us/api/v3/klines"
-    end_time = int(datetime.utcnow().timestamp() * 1000)
-    start_time = int((datetime.utcnow() - timedelta(days=1)).timestamp() * 1000)
-    closing_prices = {}
-
-    async with aiohttp.ClientSession(
-        timeout=aiohttp.ClientTimeout(total=5),
-        connector=aiohttp.TCPConnector(ssl=False)
-    ) as session:
-        tasks = [
-            session.get(url, params={
-                "symbol": symbol,
-                "interval": "1d",
-                "startTime": start_time,
-                "endTime": end_time,
-                "limit": 1
-            }, headers=HEADERS) for symbol in symbols
-        ]
-
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-
-        for symbol, response in zip(symbols, responses):
-            if isinstance(response, Exception):
-                closing_prices[symbol] = "N/A"
-                continue
-
-            try:
-                data = await response.json()
-                closing_prices[symbol] = float(data[0][4]) if data else "N/A"
-            except:
-                closing_prices[symbol] = "N/A"
-
-    return closing_prices
-
-# ---- Update Google Sheets Every Second ----
-async def update_google_sheet():
-    while True:
-        try:
-            usdt_pairs = await get_usdt_pairs()
-            if not usdt_pairs:
-                print("⚠️ No USDT pairs found. Retrying in 5 seconds...")
-                await asyncio.sleep(5)
-                continue
-            
-            live_prices, closing_prices = await asyncio.gather(
-                fetch_prices(usdt_pairs),
-                fetch_historical_data(usdt_pairs)
+# ---- Write Only Changed Rows To Google Sheets ----
+last_update_data = None
+last_digest = None
+
+def push_to_sheet(sheet, update_data):
+    global last_update_data
+    previous = last_update_data
+    if previous is not None:
+        # Column D is "Last Changed": rows whose values are unchanged keep their old timestamp, matched
+        # by symbol so a listing/delisting that shifts rows (and forces a full rewrite) doesn't restamp them.
+        # This also keeps last_update_data equal to what's actually in the sheet.
+        old_rows = {row[0]: row for row in previous[1:]}
+        for row in update_data[1:]:
+            old = old_rows.get(row[0])
+            if old is not None and old[:3] == row[:3]:
+                row[3] = old[3]
+
+    if previous is None or len(previous) != len(update_data):
+        # First push or the pair list changed: rewrite everything, blanking any leftover rows
+        padding = [["", "", "", ""]] * max(0, len(previous or []) - len(update_data))
+        values = update_data + padding
+        sheet.update(range_name=f"A1:D{len(values)}", values=values, value_input_option="RAW")
+        written = len(update_data)
+    else:
+        # Compare symbol/price/close only; unchanged rows are not rewritten
+        changed = [(i, row) for i, (row, old) in enumerate(zip(update_data, previous), 1) if row[:3] != old[:3]]
+        # Merge runs of adjacent rows into one range each, all sent in a single batchUpdate request
+        blocks = []
+        for i, row in changed:
+            if blocks and blocks[-1][0] + len(blocks[-1][1]) == i:
+                blocks[-1][1].append(row)
+            else:
+                blocks.append((i, [row]))
+        if blocks:
+            sheet.batch_update(
+                [{"range": f"A{start}:D{start + len(rows) - 1}", "values": rows} for start, rows in blocks],
+                value_input_option="RAW"
             )
+        written = len(changed)
+    last_update_data = update_data
+    return written
+
+# ---- Update Google Sheets On A Fixed Interval ----
+async def run_update(session):
+    global last_digest
+    # /ticker/24hr returns every symbol, so it doesn't need to wait for the pair list;
+    # rows are filtered down to USDT pairs when the sheet data is built
+    # The fetchers fall back to []/{} instead of raising, so only opening the sheet can fail the
+    # TaskGroup; when it does, the in-flight Binance requests are cancelled rather than awaited
+    async with asyncio.TaskGroup() as tg:
+        sheet_task = tg.create_task(asyncio.to_thread(get_sheet))
+        pairs_task = tg.create_task(get_usdt_pairs(session))
+        tickers_task = tg.create_task(fetch_tickers_24hr(session))
+    sheet, usdt_pairs, tickers = sheet_task.result(), pairs_task.result(), tickers_task.result()
+    if not usdt_pairs:
+        print(f"⚠️ No USDT pairs found. Retrying in {CONFIG.loop_interval:g} seconds...")
+        return
+    if not tickers:
+        # Keep the last good prices in the sheet rather than overwriting them with N/A
+        print(f"⚠️ No ticker data from Binance. Retrying in {CONFIG.loop_interval:g} seconds...")
+        return
+
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+    # Only what goes into the sheet is fingerprinted; ticks on non-USDT pairs don't count as changes
+    tickers_get = tickers.get
+    missing = ("N/A", "N/A")
+    prices = [(s, tickers_get(s, missing)) for s in usdt_pairs]
+    digest = hashlib.blake2b(orjson.dumps(prices), digest_size=16).digest()
+    if digest == last_digest:
+        print(f"[{timestamp}] 💤 No price changes, skipped Google Sheet write")
+        return
+
+    update_data = [None] * (len(prices) + 1)
+    update_data[0] = ["Symbol", "Price", "Last Close", "Last Changed"]
+    for i, (s, (last, close)) in enumerate(prices, 1):
+        update_data[i] = [s, last, close, timestamp]
 
-            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            update_data = [["Symbol", "Price", "Last Close", "Updated At"]]
-            update_data += [[s, live_prices.get(s, "N/A"), closing_prices.get(s, "N/A"), timestamp] for s in usdt_pairs]
+    written = await asyncio.to_thread(push_to_sheet, sheet, update_data)
+    last_digest = digest
+    print(f"[{timestamp}] ✅ Google Sheet updated! ({written} rows written)")
 
-            sheet.update(range_name="A1", values=update_data)
-            print(f"[{timestamp}] ✅ Google Sheet updated!")
+async def update_google_sheet(session):
+    interval = CONFIG.loop_interval
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    while True:
+        try:
+            await run_update(session)
         except Exception as e:
-            print(f"⚠️ Error updating Google Sheets: {e}. Retrying in 5 seconds...")
-        
-        await asyncio.sleep(5)  # Update every 5 seconds
+            errors = e.exceptions if isinstance(e, ExceptionGroup) else [e]
+            print(f"⚠️ Error updating Google Sheets: {'; '.join(map(str, errors))}. Retrying in {interval:g} seconds...")
+
+        # Sleep until the next slot on a fixed grid; if an update overran, skip the missed slots
+        next_tick += interval
+        now = loop.time()
+        if next_tick < now:
+            next_tick += ((now - next_tick) // interval + 1) * interval
+        await asyncio.sleep(next_tick - now)
 
 # ---- Start Web Server ----
 async def handle(request):
@@ -140,10 +353,14 @@ async def start_server():
 
 # ---- Run Everything ----
 async def main():
-    await asyncio.gather(
-        start_server(),
-        update_google_sheet()
-    )
+    session = create_session()
+    try:
+        await asyncio.gather(
+            start_server(),
+            update_google_sheet(session)
+        )
+    finally:
+        await session.close()
 
 if __name__ == "__main__":
     asyncio.run(main())